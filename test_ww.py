@@ -0,0 +1,281 @@
+'''
+Behaviour tests for the Stage: every way of running it (trap detection
+modes, vectorized storage, snapshots) must play out the same game.
+
+Run them with: python -m unittest test_ww
+'''
+
+import os, random, sys, unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+from ww import *
+
+# Stage options for every mode that is meant to play the same game as
+# the default one
+MODES = [
+    {},
+    {'trap_detection': 'incremental'},
+    {'vectorized': True},
+    {'vectorized': True, 'trap_detection': 'grid'},
+    {'vectorized': True, 'trap_detection': 'incremental'},
+]
+
+KEYS = list(KeyboardPlayer.key_moves)
+
+
+def random_stage(seed, size=12, actors=50, **options):
+    '''
+    (int, int, int, ...) -> Stage
+    Return a headless size x size Stage with a KeyboardPlayer, an
+    ExplodingMonster and actors Boxes, StickyBoxes, Walls and monsters,
+    placed at random by a generator seeded with seed.
+    '''
+
+    rng = random.Random(seed)
+    stage = Stage(size, size, 24, headless=True, **options)
+    stage.set_player(KeyboardPlayer("icons/face-cool-24-up.png", stage))
+    kinds = [Box, Box, StickyBox, Wall, NormalMonster, EzMonster]
+    stage.add_actors([rng.choice(kinds)("icon", stage, x, y) for (x, y) in stage.sample_free_cells(actors, rng)])
+    (x, y) = stage.sample_free_cells(1, rng)[0]
+    stage.add_actor(ExplodingMonster("icon", stage, x, y, 1, rng.randint(5, 30)))
+    return stage
+
+
+def play(stage, keys):
+    '''
+    (Stage, list of int) -> list of int
+    Press each of keys before a step of stage, and return the state hash
+    after every step.
+    '''
+
+    hashes = []
+    for key in keys:
+        stage.player_event(key)
+        stage.step()
+        hashes.append(stage.state_hash())
+    return hashes
+
+
+def random_keys(seed, n):
+    rng = random.Random(seed)
+    return [rng.choice(KEYS) for _ in range(n)]
+
+
+class ModesTest(unittest.TestCase):
+
+    def test_modes_play_the_same_game(self):
+        for seed in range(40):
+            keys = random_keys(seed, 200)
+            expected = play(random_stage(seed), keys)
+            for options in MODES[1:]:
+                with self.subTest(seed=seed, options=options):
+                    self.assertEqual(play(random_stage(seed, **options), keys), expected)
+
+    def test_monster_added_before_the_player_steps_first(self):
+        for options in MODES:
+            with self.subTest(options=options):
+                stage = Stage(5, 5, 24, headless=True, **options)
+                stage.add_actor(NormalMonster("icon", stage, 1, 1, 1))
+                stage.set_player(KeyboardPlayer("icon", stage, 2, 2))
+                stage.player_event(pygame.K_RIGHT)
+                stage.step()
+                stage.step()
+                self.assertEqual(stage.get_player().life, 0)
+
+    def test_monster_killed_after_its_step(self):
+        # the EzMonster steps first, without moving, and is then killed by
+        # the player in the same tick
+        expected = None
+        for options in MODES:
+            with self.subTest(options=options):
+                stage = Stage(5, 5, 24, headless=True, **options)
+                monster = EzMonster("icon", stage, 2, 2)
+                stage.add_actor(monster)
+                stage.set_player(KeyboardPlayer("icon", stage, 1, 2))
+                hashes = play(stage, [pygame.K_RIGHT, pygame.K_DOWN, pygame.K_DOWN])
+                self.assertFalse(stage.has_actor(monster))
+                if expected is None:
+                    expected = hashes
+                self.assertEqual(hashes, expected)
+
+    def test_first_actor_is_the_first_added(self):
+        # the player walks into the exploding monster's cell, but was added
+        # before it, so the player is the first Actor there and the
+        # explosion kills it
+        for options in MODES:
+            with self.subTest(options=options):
+                stage = Stage(6, 6, 24, headless=True, **options)
+                stage.set_player(KeyboardPlayer("icon", stage, 1, 1))
+                stage.add_actor(ExplodingMonster("icon", stage, 2, 1, 1, 30))
+                stage.add_actor(NormalMonster("icon", stage, 1, 0, 1))
+                stage.player_event(pygame.K_RIGHT)
+                stage.step()
+                self.assertEqual(stage.get_player().life, 0)
+
+
+class LevelTest(unittest.TestCase):
+
+    TILES = {
+        '#': (Wall, "icon", ()),
+        'B': (Box, "icon", ()),
+        'S': (StickyBox, "icon", ()),
+        'P': (KeyboardPlayer, "icon", ()),
+        'N': (NormalMonster, "icon", (3,)),
+        'E': (EzMonster, "icon", (3,)),
+        'X': (ExplodingMonster, "icon", (1, 20)),
+    }
+
+    def test_load_level_plays_like_add_actors(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            rows = [bytes([ord(rng.choice('.......#BBSNEX')) for x in range(16)]) for y in range(16)]
+            rows[0] = b'P' + rows[0][1:] # so the player comes first either way
+            keys = random_keys(seed, 150)
+            for options in MODES:
+                with self.subTest(seed=seed, options=options):
+                    loaded = Stage(16, 16, 24, headless=True, **options)
+                    loaded.load_level(rows, self.TILES)
+
+                    added = Stage(16, 16, 24, headless=True, **options)
+                    actors = []
+                    for y in range(16):
+                        for x in range(16):
+                            if rows[y][x] != ord('.'):
+                                (actor_class, icon_file, args) = self.TILES[chr(rows[y][x])]
+                                actors.append(actor_class(icon_file, added, x, y, *args))
+                    added.set_player(actors[0])
+                    added.add_actors(actors[1:])
+
+                    self.assertEqual(play(loaded, keys), play(added, keys))
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_replay_reproduces_a_recorded_game(self):
+        import tempfile, wwreplay
+        make_stage = lambda seed, headless: random_stage(seed)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'game.wwr')
+            stage = make_stage(7, headless=True)
+            recorder = wwreplay.Recorder(stage, open(path, 'wb'), 7, checkpoint_every=20)
+            for key in random_keys(7, 130):
+                recorder.key(key)
+                stage.player_event(key)
+                stage.step()
+                recorder.stepped()
+            recorder.close()
+
+            (replayed, checkpoints) = wwreplay.replay(path, make_stage)
+            self.assertEqual(replayed.get_tick(), stage.get_tick())
+            self.assertEqual(replayed.state_hash(), stage.state_hash())
+            self.assertEqual(checkpoints, 130 // 20 + 1)
+
+            # a different game fails its first checkpoint
+            with self.assertRaises(ValueError):
+                wwreplay.replay(path, lambda seed, headless: random_stage(seed + 1))
+
+
+class PushTest(unittest.TestCase):
+
+    def test_push_a_row_longer_than_the_recursion_limit(self):
+        n = sys.getrecursionlimit() + 1000
+        for options in MODES:
+            with self.subTest(options=options):
+                stage = Stage(n + 3, 1, 24, headless=True, **options)
+                stage.set_player(KeyboardPlayer("icon", stage, 0, 0))
+                boxes = [Box("icon", stage, x, 0) for x in range(1, n + 1)]
+                stage.add_actors(boxes)
+                stage.player_event(pygame.K_RIGHT)
+                stage.step()
+                self.assertEqual(stage.get_player().get_position(), (1, 0))
+                self.assertEqual([box.get_position() for box in boxes], [(x, 0) for x in range(2, n + 2)])
+
+    def test_sticky_box_catches_the_monster_it_is_pushed_into(self):
+        # the monster cannot make room (the wall is behind it), so the push
+        # fails but the monster is stuck to the box where it stands
+        for options in MODES:
+            with self.subTest(options=options):
+                stage = Stage(5, 3, 24, headless=True, **options)
+                stage.set_player(KeyboardPlayer("icon", stage, 0, 1))
+                box = StickyBox("icon", stage, 1, 1)
+                monster = NormalMonster("icon", stage, 2, 1, 1)
+                stage.add_actors([box, monster, Wall("icon", stage, 3, 1)])
+                stage.player_event(pygame.K_RIGHT)
+                stage.step()
+                stage.step() # the monster's next step must see what it is stuck to
+                self.assertTrue(monster.stuck)
+                self.assertIs(monster.stick_with, box)
+                self.assertEqual(monster.stick_position, (1, 1))
+                self.assertEqual(monster.get_position(), (2, 1))
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_restore_replays_the_same_game(self):
+        for seed in range(10):
+            for options in MODES:
+                with self.subTest(seed=seed, options=options):
+                    stage = random_stage(seed, **options)
+                    play(stage, random_keys(seed + 1000, seed * 3))
+                    snapshot = stage.snapshot()
+                    start = stage.state_hash()
+                    keys = random_keys(seed, 150)
+                    expected = play(stage, keys)
+
+                    stage.restore(snapshot)
+                    self.assertEqual(stage.state_hash(), start)
+                    self.assertEqual(play(stage, keys), expected)
+
+                    # the same snapshot can be restored again, and one taken
+                    # after a restore works too
+                    stage.restore(snapshot)
+                    self.assertEqual(play(stage, keys[:70]), expected[:70])
+                    middle = stage.snapshot()
+                    self.assertEqual(play(stage, keys[70:]), expected[70:])
+                    stage.restore(middle)
+                    self.assertEqual(play(stage, keys[70:]), expected[70:])
+
+    def test_restore_keeps_grid_views_current(self):
+        stage = random_stage(3, vectorized=True)
+        grid = stage.get_grid()
+        life = stage.get_grid('life')
+        snapshot = stage.snapshot()
+        (grid_before, life_before) = (grid.copy(), life.copy())
+        play(stage, random_keys(3, 50))
+        stage.restore(snapshot)
+        self.assertTrue((grid == grid_before).all())
+        self.assertTrue((life == life_before).all())
+
+
+def icon(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icons', name)
+
+
+class DrawTest(unittest.TestCase):
+
+    def test_dirty_and_full_redraws_agree_on_shared_cells(self):
+        pygame.init()
+        stage = Stage(4, 4, 24, dirty_rects=True)
+        box = Box(icon("emblem-package-2-24.png"), stage, 2, 2)
+        stage.add_actor(box)
+        stage.set_player(KeyboardPlayer(icon("face-cool-24-up.png"), stage, 1, 1))
+        stage.add_actor(ExplodingMonster(icon("face-angry.png"), stage, 1, 1, 1, 20))
+        # the monster was added to (1, 1) after the player, so it is drawn on
+        # top; removing the box moves it to the front of the actor list (see
+        # _discard_actor), which must not change that
+        stage.remove_actor(box)
+        stage.draw()
+        stage.actor_changed(stage.get_player()) # repaint the cell the dirty way
+        stage.draw()
+        dirty = pygame.image.tostring(pygame.display.get_surface(), 'RGB')
+        stage._full_redraw = True
+        stage.draw()
+        full = pygame.image.tostring(pygame.display.get_surface(), 'RGB')
+        self.assertEqual(dirty, full)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+'''
+Running many seeded games headless, spread over a pool of processes.
+
+Each game is built by wwgame.make_stage(seed) (or loaded from a level
+file), played for up to a number of ticks by a random or scripted player,
+and boiled down to one compact result record (see RESULT_FIELDS). The
+records stream back as games finish and are summed up at the end:
+
+    python -m wwbatch --games 1000 --ticks 500 --policy random
+    python -m wwbatch --games 1000 --script game.wwr --output results.jsonl
+
+Games share nothing, so throughput grows with the number of processes.
+'''
+
+import argparse, functools, json, multiprocessing, os, random, time
+
+# keep pygame's greeting out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+from ww import *
+
+# the fields of a result record, in order
+RESULT_FIELDS = (
+    'seed',
+    'ticks', # ticks survived (all of them, if the player lived)
+    'cause', # class name of the Actor that killed the player, or None
+    'trapped_ticks', # total ticks NormalMonsters spent trapped
+    'monsters_trapped', # NormalMonsters that were trapped at least once
+)
+
+# what the player may press: a random key each tick, or nothing at all
+POLICIES = ('random', 'idle')
+KEYS = list(KeyboardPlayer.key_moves)
+
+
+def run_game(seed, ticks, policy='random', script=None, level=None):
+    '''
+    (int, int, str, list of (int, int), str) -> tuple
+    Play one headless game and return its result record (see
+    RESULT_FIELDS). The game is built from seed by wwgame.make_stage, or
+    loaded from the level file level, and runs for at most ticks ticks.
+    The player presses the (tick, key) pairs in script before those ticks
+    if it is given, and otherwise follows policy, with a random number
+    generator seeded with seed.
+    '''
+
+    if level is not None:
+        from wwlevel import load_level
+        stage = load_level(level, 24, headless=True)
+    else:
+        from wwgame import make_stage
+        stage = make_stage(seed, headless=True)
+    player = stage.get_player()
+    if player is None:
+        raise ValueError('the game has no player')
+    monsters = [actor for actor in stage.get_actors() if isinstance(actor, NormalMonster)]
+    keys = {}
+    for (tick, key) in script or ():
+        keys.setdefault(tick, []).append(key)
+    rng = random.Random(seed)
+
+    trapped_ticks = 0
+    ever_trapped = set()
+    while stage.get_tick() < ticks and player.life != 0:
+        if script is not None:
+            for key in keys.get(stage.get_tick(), ()):
+                stage.player_event(key)
+        elif policy == 'random':
+            stage.player_event(rng.choice(KEYS))
+        stage.step()
+        for monster in monsters:
+            if monster.trapped and stage.has_actor(monster):
+                trapped_ticks += 1
+                ever_trapped.add(monster)
+
+    cause = None
+    if player.killed_by is not None:
+        cause = type(player.killed_by).__name__
+    return (seed, stage.get_tick(), cause, trapped_ticks, len(ever_trapped))
+
+
+def run_games(seeds, ticks, policy='random', script=None, level=None, processes=None, chunksize=16):
+    '''
+    (iterable of int, int, str, list of (int, int), str, int, int) -> iterator of tuple
+    Run a game (see run_game) for each of seeds on a pool of processes
+    (one per CPU by default), and yield the result records in the order
+    the games finish.
+    '''
+
+    game = functools.partial(run_game, ticks=ticks, policy=policy, script=script, level=level)
+    with multiprocessing.Pool(processes) as pool:
+        for record in pool.imap_unordered(game, seeds, chunksize):
+            yield record
+
+
+def summarize(records):
+    '''
+    (list of tuple) -> dict
+    Sum up result records: how many games were played and survived, deaths
+    by cause, and the mean of the numeric fields.
+    '''
+
+    n = len(records)
+    deaths = {}
+    for record in records:
+        if record[2] is not None:
+            deaths[record[2]] = deaths.get(record[2], 0) + 1
+    result = {'games': n, 'survived': n - sum(deaths.values()), 'deaths': deaths}
+    for (i, field) in enumerate(RESULT_FIELDS):
+        if field in ('ticks', 'trapped_ticks', 'monsters_trapped'):
+            result['mean_' + field] = sum(record[i] for record in records) / n if n else None
+    return result
+
+
+def main(argv=None):
+    '''
+    (list of str) -> None
+    Parse command line arguments, run the games and print a summary of
+    their results as JSON.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m wwbatch', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--games', type=int, default=100, help='number of games to play')
+    parser.add_argument('--first-seed', type=int, default=0, help='games use consecutive seeds from this one')
+    parser.add_argument('--ticks', type=int, default=500, help='most ticks to play each game for')
+    parser.add_argument('--policy', choices=POLICIES, default='random', help='how the player picks keys')
+    parser.add_argument('--script', metavar='RECORDING',
+                        help='press the keys of this wwreplay recording instead of following a policy')
+    parser.add_argument('--level', help='play this level file (see wwlevel.py) instead of wwgame.make_stage')
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--output', help='also write every result record here, one JSON list per line')
+    args = parser.parse_args(argv)
+
+    script = None
+    if args.script:
+        from wwreplay import read_recording, KEY_TAG
+        with open(args.script, 'rb') as f:
+            (seed, records) = read_recording(f)
+        script = [(tick, key) for (tag, tick, key) in records if tag == KEY_TAG]
+
+    start = time.perf_counter()
+    seeds = range(args.first_seed, args.first_seed + args.games)
+    records = []
+    output = open(args.output, 'w') if args.output else None
+    try:
+        for record in run_games(seeds, args.ticks, args.policy, script, args.level, args.processes):
+            records.append(record)
+            if output is not None:
+                output.write(json.dumps(record) + '\n')
+    finally:
+        if output is not None:
+            output.close()
+    seconds = time.perf_counter() - start
+
+    result = summarize(records)
+    result['seconds'] = seconds
+    result['games_per_sec'] = len(records) / seconds if seconds > 0 else None
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+'''
+Benchmarks for the Stage simulation and drawing.
+
+Builds seeded scenarios out of the classes in ww.py, times Stage.step,
+Stage.draw, Stage.get_actor and Monster.is_trapped separately, and prints
+the results as JSON. Run it with, for example:
+
+    python -m wwbench --sizes 20 100 200 --box-density 0.25 --ticks 200
+'''
+
+import argparse, json, os, random, time, tracemalloc
+
+# drawing is timed against an off-screen display unless a real one is asked for
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+# keep pygame's greeting out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+from ww import *
+
+PLAYER_ICON = "icons/face-cool-24-up.png"
+BOX_ICON = "icons/emblem-package-2-24.png"
+STICKY_BOX_ICON = "icons/applications.ico"
+NORMAL_MONSTER_ICON = "icons/face-devil-grin-24.png"
+EZ_MONSTER_ICON = "icons/face-sick.png"
+EXPLODING_MONSTER_ICON = "icons/face-angry.png"
+
+# keys the simulated player presses, one per tick
+KEYS = list(KeyboardPlayer.key_moves)
+
+
+def build_stage(size, box_density, sticky_fraction, normal_monsters, ez_monsters,
+                exploding_monsters, seed, headless=True, icon_dimension=24, vectorized=False,
+                trap_detection='scan'):
+    '''
+    (int, float, float, int, int, int, int, bool, int, bool, str) -> Stage
+    Build a size x size Stage with a KeyboardPlayer at (0, 0), a fraction
+    box_density of the cells filled with boxes (sticky_fraction of them
+    StickyBoxes), and the given number of each kind of monster, all placed
+    by a random number generator seeded with seed. vectorized and
+    trap_detection are passed on to Stage.
+    '''
+
+    rng = random.Random(seed)
+    stage = Stage(size, size, icon_dimension, headless=headless, vectorized=vectorized,
+                  trap_detection=trap_detection)
+    stage.set_player(KeyboardPlayer(PLAYER_ICON, stage))
+
+    def place(make, count):
+        stage.add_actors([make(x, y) for (x, y) in stage.sample_free_cells(count, rng)])
+
+    num_boxes = int(size * size * box_density)
+    num_sticky_boxes = int(num_boxes * sticky_fraction)
+    place(lambda x, y: Box(BOX_ICON, stage, x, y), num_boxes - num_sticky_boxes)
+    place(lambda x, y: StickyBox(STICKY_BOX_ICON, stage, x, y), num_sticky_boxes)
+    place(lambda x, y: NormalMonster(NORMAL_MONSTER_ICON, stage, x, y, rng.randint(1, 5)), normal_monsters)
+    place(lambda x, y: EzMonster(EZ_MONSTER_ICON, stage, x, y, rng.randint(1, 5)), ez_monsters)
+    place(lambda x, y: ExplodingMonster(EXPLODING_MONSTER_ICON, stage, x, y, 1, rng.randint(10, 40)), exploding_monsters)
+    return stage
+
+
+def percentile(samples, p):
+    '''
+    (list of float, float) -> float
+    Return the p-th percentile (0 <= p <= 100) of samples.
+    '''
+
+    ordered = sorted(samples)
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+
+def summarize(samples):
+    '''
+    (list of float) -> dict
+    Summarize per-call latencies (in seconds) as calls per second and the
+    median and 99th percentile latency in microseconds.
+    '''
+
+    total = sum(samples)
+    return {
+        'per_sec': len(samples) / total if total > 0 else None,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p99_us': percentile(samples, 99) * 1e6,
+    }
+
+
+def time_step(stage, ticks, seed):
+    '''
+    (Stage, int, int) -> list of float
+    Run ticks steps of stage, pressing a random key before each, and
+    return how long each step took.
+    '''
+
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(ticks):
+        stage.player_event(rng.choice(KEYS))
+        start = time.perf_counter()
+        stage.step()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_draw(stage, frames):
+    '''
+    (Stage, int) -> list of float
+    Draw stage frames times, stepping it in between, and return how long
+    each draw took.
+    '''
+
+    samples = []
+    for _ in range(frames):
+        stage.step()
+        start = time.perf_counter()
+        stage.draw()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_get_actor(stage, calls, seed):
+    '''
+    (Stage, int, int) -> list of float
+    Look up calls random cells of stage and return how long each took.
+    '''
+
+    rng = random.Random(seed)
+    cells = [(rng.randrange(stage.get_width()), rng.randrange(stage.get_height())) for _ in range(calls)]
+    samples = []
+    for (x, y) in cells:
+        start = time.perf_counter()
+        stage.get_actor(x, y)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_is_trapped(stage):
+    '''
+    (Stage) -> list of float
+    Ask every Monster on stage whether it is trapped and return how long
+    each call took.
+    '''
+
+    samples = []
+    for actor in list(stage.get_actors()):
+        if isinstance(actor, Monster):
+            start = time.perf_counter()
+            actor.is_trapped()
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_memory(scenario, ticks):
+    '''
+    (dict, int) -> int
+    Return the peak number of bytes allocated while building the headless
+    stage described by scenario and running it for ticks steps.
+    '''
+
+    tracemalloc.start()
+    stage = build_stage(**scenario)
+    for _ in range(ticks):
+        stage.step()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def actor_memory(count):
+    '''
+    (int) -> dict
+    Return the number of bytes each kind of Actor takes up, measured as
+    the memory allocated by creating count of them, divided by count.
+    The references in the list holding them are not counted.
+    '''
+
+    stage = Stage(1, 1, 24, headless=True)
+    kinds = [
+        (Box, (BOX_ICON, stage)),
+        (StickyBox, (STICKY_BOX_ICON, stage)),
+        (Wall, ("icons/wall.jpg", stage)),
+        (NormalMonster, (NORMAL_MONSTER_ICON, stage, 0, 0, 3)),
+        (ExplodingMonster, (EXPLODING_MONSTER_ICON, stage, 0, 0, 1, 20)),
+        (KeyboardPlayer, (PLAYER_ICON, stage)),
+    ]
+    result = {}
+    for (cls, args) in kinds:
+        actors = [None] * count
+        tracemalloc.start()
+        for i in range(count):
+            actors[i] = cls(*args)
+        result[cls.__name__] = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+    return result
+
+
+def run_scenario(scenario, ticks, frames, lookups, draw_max_size):
+    '''
+    (dict, int, int, int, int) -> dict
+    Benchmark one scenario (keyword arguments for build_stage) and return
+    its results.
+    '''
+
+    result = dict(scenario)
+
+    stage = build_stage(**scenario)
+    result['actors'] = len(stage.get_actors())
+    result['get_actor'] = summarize(time_get_actor(stage, lookups, scenario['seed']))
+    trapped = time_is_trapped(stage)
+    result['is_trapped'] = summarize(trapped) if trapped else None
+    result['step'] = summarize(time_step(stage, ticks, scenario['seed']))
+
+    result['draw'] = None
+    if frames > 0 and scenario['size'] <= draw_max_size:
+        drawn = dict(scenario, headless=False)
+        result['draw'] = summarize(time_draw(build_stage(**drawn), frames))
+
+    result['peak_memory_bytes'] = peak_memory(scenario, min(ticks, 10))
+    return result
+
+
+def main(argv=None):
+    '''
+    (list of str) -> None
+    Parse command line arguments, run every requested scenario and print
+    the results as a JSON list.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m wwbench', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 50, 100, 200],
+                        help='stage widths (stages are square)')
+    parser.add_argument('--box-density', type=float, default=0.225,
+                        help='fraction of cells holding a box (wwgame.py uses 0.225)')
+    parser.add_argument('--sticky-fraction', type=float, default=0.1,
+                        help='fraction of boxes that are StickyBoxes')
+    parser.add_argument('--monster-density', type=float, default=0.01,
+                        help='NormalMonsters and EzMonsters per cell, split evenly')
+    parser.add_argument('--exploding', type=int, default=2,
+                        help='number of ExplodingMonsters')
+    parser.add_argument('--ticks', type=int, default=200, help='steps to time per scenario')
+    parser.add_argument('--frames', type=int, default=50, help='draws to time per scenario')
+    parser.add_argument('--lookups', type=int, default=10000, help='get_actor calls to time')
+    parser.add_argument('--draw-max-size', type=int, default=200,
+                        help='skip drawing on stages wider than this')
+    parser.add_argument('--icon-size', type=int, default=24, help='pixel size of a cell')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='keep the actors in an ActorStore (see wwstore.py)')
+    parser.add_argument('--trap-detection', choices=['scan', 'grid', 'incremental'], default='scan',
+                        help="how Monsters find out they are trapped ('grid' needs --vectorized)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--actor-memory', type=int, metavar='COUNT',
+                        help='instead of timing, report bytes per actor measured over COUNT actors of each kind')
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    if args.actor_memory:
+        results = actor_memory(args.actor_memory)
+    else:
+        results = run_scenarios(args)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def run_scenarios(args):
+    '''
+    (argparse.Namespace) -> list of dict
+    Run the scenario for every size in args.sizes and return the results.
+    '''
+
+    results = []
+    for size in args.sizes:
+        monsters = int(size * size * args.monster_density)
+        scenario = {
+            'size': size,
+            'box_density': args.box_density,
+            'sticky_fraction': args.sticky_fraction,
+            'normal_monsters': (monsters + 1) // 2,
+            'ez_monsters': monsters // 2,
+            'exploding_monsters': args.exploding,
+            'seed': args.seed,
+            'icon_dimension': args.icon_size,
+            'vectorized': args.vectorized,
+            'trap_detection': args.trap_detection,
+        }
+        results.append(run_scenario(scenario, args.ticks, args.frames, args.lookups, args.draw_max_size))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+'''
+An environment interface to the game, for training agents.
+
+GameEnv wraps one headless game in the usual reset/step interface: reset
+starts a new game and returns the first observation, and step takes an
+action (an index into ACTIONS, the eight keypad directions) and returns
+(observation, reward, done, info). An observation is the Stage's grid
+(see Stage.get_grid): a read-only height x width int8 array holding the
+type id (see wwstore.py) of the first Actor in each cell.
+
+VecEnv steps several GameEnvs in lockstep and returns their observations
+stacked in one (n, height, width) array, together with arrays of rewards
+and done flags, all preallocated and refilled in place on every step.
+A game that ends is started again straight away with its next seed.
+
+This module needs NumPy.
+'''
+
+import os
+
+# keep pygame's greeting quiet
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import numpy, pygame
+from ww import *
+
+# action -> key pressed: down, left, right, up, then the diagonals
+# up-left, up-right, down-left and down-right
+ACTIONS = [
+    pygame.K_KP5, pygame.K_KP4, pygame.K_KP6, pygame.K_KP8,
+    pygame.K_KP7, pygame.K_KP9, pygame.K_KP1, pygame.K_KP3,
+]
+
+SURVIVAL_REWARD = 1.0 # for every tick the player lives through
+DEATH_REWARD = -10.0 # for the tick the player dies on
+
+
+def make_game(seed):
+    '''
+    (int) -> Stage
+    Return the game wwgame.py plays, built from seed, as a headless
+    vectorized Stage.
+    '''
+
+    from wwgame import make_stage
+    return make_stage(seed, headless=True, vectorized=True)
+
+
+class GameEnv:
+    '''
+    One game, played one action per tick.
+    '''
+
+    def __init__(self, seed=0, seed_step=1, max_ticks=1000, make_stage=make_game):
+        '''
+        (GameEnv, int, int, int, function) -> None
+        Construct a GameEnv whose games are built by make_stage(seed), which
+        must return a vectorized Stage with a Player. The first game is
+        built from seed and each later one from the seed before plus
+        seed_step. A game ends when the player dies or after max_ticks ticks.
+        '''
+
+        self._seed = seed - seed_step # reset adds seed_step
+        self._seed_step = seed_step
+        self._max_ticks = max_ticks
+        self._make_stage = make_stage
+        self.stage = None
+        self._grid = None # self.stage.get_grid()
+
+    def reset(self, seed=None):
+        '''
+        (GameEnv, int) -> numpy.ndarray
+        Start a new game, built from seed if it is given and from the next
+        seed otherwise, and return its first observation.
+        '''
+
+        if seed is None:
+            seed = self._seed + self._seed_step
+        self._seed = seed
+        self.stage = self._make_stage(seed)
+        if self.stage.get_player() is None:
+            raise ValueError('the game has no player')
+        self._grid = self.stage.get_grid()
+        return self._grid
+
+    def observation(self):
+        '''
+        (GameEnv) -> numpy.ndarray
+        Return the grid of the current game. It is a live view, not a
+        copy, so it changes as the game goes on; copy it to keep it.
+        '''
+
+        return self._grid
+
+    def act(self, action):
+        '''
+        (GameEnv, int) -> (float, bool)
+        Press the key for action, run one tick, and return the reward for
+        it and whether the game is over. Nothing is observed, see step.
+        '''
+
+        stage = self.stage
+        stage.player_event(ACTIONS[action])
+        stage.step()
+        if stage.get_player().life == 0:
+            return (DEATH_REWARD, True)
+        return (SURVIVAL_REWARD, stage.get_tick() >= self._max_ticks)
+
+    def step(self, action):
+        '''
+        (GameEnv, int) -> (numpy.ndarray, float, bool, dict)
+        Press the key for action and run one tick. Return the observation
+        after it, the reward for it, whether the game is over, and a dict
+        with the tick and, if the player died, the class name of its killer.
+        '''
+
+        (reward, done) = self.act(action)
+        info = {'tick': self.stage.get_tick()}
+        killer = self.stage.get_player().killed_by
+        if killer is not None:
+            info['cause'] = type(killer).__name__
+        return (self.observation(), reward, done, info)
+
+
+class VecEnv:
+    '''
+    n GameEnvs stepped in lockstep, with their observations, rewards and
+    done flags in shared preallocated arrays.
+    '''
+
+    def __init__(self, n, seed=0, max_ticks=1000, make_stage=make_game):
+        '''
+        (VecEnv, int, int, int, function) -> None
+        Construct a VecEnv of n GameEnvs. Environment i plays the games
+        built from seeds seed + i, seed + i + n, seed + i + 2n, ...
+        '''
+
+        self.envs = [GameEnv(seed + i, n, max_ticks, make_stage) for i in range(n)]
+        self.observations = None # (n, height, width), allocated by reset
+        self.rewards = numpy.zeros(n, numpy.float32)
+        self.dones = numpy.zeros(n, bool)
+
+    def reset(self):
+        '''
+        (VecEnv) -> numpy.ndarray
+        Start a new game in every environment and return their stacked
+        observations.
+        '''
+
+        for (i, env) in enumerate(self.envs):
+            grid = env.reset()
+            if self.observations is None:
+                self.observations = numpy.zeros((len(self.envs),) + grid.shape, grid.dtype)
+            self.observations[i] = grid
+        return self.observations
+
+    def step(self, actions):
+        '''
+        (VecEnv, sequence of int) -> (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        Take actions[i] in environment i, for every i, and return the
+        stacked observations, the rewards and the done flags. An
+        environment whose game ended starts its next game, and its
+        observation is the first one of that game.
+        The arrays returned are overwritten by the next step.
+        '''
+
+        observations = self.observations
+        rewards = self.rewards
+        dones = self.dones
+        for (i, env) in enumerate(self.envs):
+            (rewards[i], dones[i]) = env.act(actions[i])
+            if dones[i]:
+                env.reset()
+            observations[i] = env.observation()
+        return (observations, rewards, dones)
@@ -1,46 +1,70 @@
-import sys, pygame, random
+import argparse, sys, pygame, random
 from ww import *
-pygame.init()
-pygame.key.set_repeat(100, 50) # keyboard repeat behaviour. (delay, interval) unit: millisecond.
-
-ww=Stage(20, 20, 24)
-ww.set_player(KeyboardPlayer("icons/face-cool-24-up.png", ww))
-ww.add_actor(Wall("icons/wall.jpg", ww, 3, 4))
-ww.add_actor(ExplodingMonster("icons/face-angry.png", ww, 0, 3, 1, 20))
-ww.add_actor(ExplodingMonster("icons/face-angry.png", ww, 7, 4, 1, 20))
-ww.add_actor(NormalMonster("icons/face-devil-grin-24.png", ww, 4, 10, 3))
-ww.add_actor(NormalMonster("icons/face-devil-grin-24.png", ww, 5, 20, 2))
-ww.add_actor(EzMonster("icons/face-sick.png", ww, 2, 4, 3))
-# the greater the value of delay, the slower the monster will move.
-# if the EzMonster touch Player, Player will die.
-# the forth value of ExplodingMonster is delay time of explotion.
-
-# YOUR COMMENT GOES HERE. BRIEFLY DESCRIBE WHAT THE FOLLOWING LOOP DOES.
-num_boxes=0
-while num_boxes<90:
-    x=random.randrange(ww.get_width())
-    y=random.randrange(ww.get_height())
-    if ww.get_actor(x,y) is None:
-        ww.add_actor(Box("icons/emblem-package-2-24.png", ww, x, y))
-        num_boxes+=1
-
-num_sticky_boxes=0
-while num_sticky_boxes<10:
-    x=random.randrange(ww.get_width())
-    y=random.randrange(ww.get_height())
-    if ww.get_actor(x,y) is None:
-        ww.add_actor(StickyBox("icons/applications.ico", ww, x, y)) #TODO: find an special icon for sticky boxes.
-        num_sticky_boxes+=1
-
-pygame.mixer.music.load('background.mid')
-pygame.mixer.music.play(-1, 0.0)
-
-# YOUR COMMENT GOES HERE. BRIEFLY DESCRIBE WHAT THE FOLLOWING LOOP DOES.
-while True:
-    pygame.time.wait(100)
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT: sys.exit()
-        if event.type == pygame.KEYDOWN:
-                ww.player_event(event.key)
-    ww.step()
-    ww.draw()
\ No newline at end of file
+from wwloop import GameLoop
+from wwreplay import Recorder
+
+
+def make_stage(seed, headless=False, vectorized=False):
+    '''
+    (int, bool, bool) -> Stage
+    Build the game's Stage, placing the boxes with a random number
+    generator seeded with seed, so that the same seed always gives the
+    same game. headless and vectorized are passed on to Stage.
+    '''
+
+    rng = random.Random(seed)
+    ww=Stage(20, 20, 24, dirty_rects=True, headless=headless, vectorized=vectorized)
+    ww.set_player(KeyboardPlayer("icons/face-cool-24-up.png", ww))
+    ww.add_actor(Wall("icons/wall.jpg", ww, 3, 4))
+    ww.add_actor(ExplodingMonster("icons/face-angry.png", ww, 0, 3, 1, 20))
+    ww.add_actor(ExplodingMonster("icons/face-angry.png", ww, 7, 4, 1, 20))
+    ww.add_actor(NormalMonster("icons/face-devil-grin-24.png", ww, 4, 10, 3))
+    ww.add_actor(NormalMonster("icons/face-devil-grin-24.png", ww, 5, 20, 2))
+    ww.add_actor(EzMonster("icons/face-sick.png", ww, 2, 4, 3))
+    # the greater the value of delay, the slower the monster will move.
+    # if the EzMonster touch Player, Player will die.
+    # the forth value of ExplodingMonster is delay time of explotion.
+
+    # place 90 boxes and 10 sticky boxes on empty cells picked at random
+    ww.populate(Box, "icons/emblem-package-2-24.png", 90, rng=rng)
+    ww.populate(StickyBox, "icons/applications.ico", 10, rng=rng) #TODO: find an special icon for sticky boxes.
+    return ww
+
+
+def main(argv=None):
+    '''
+    (list of str) -> None
+    Play the game in a window, optionally recording it for wwreplay.py.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python wwgame.py')
+    parser.add_argument('--seed', type=int, help='seed for placing the boxes (random if not given)')
+    parser.add_argument('--record', metavar='PATH', help='record the game to PATH, see wwreplay.py')
+    args = parser.parse_args(argv)
+    seed = args.seed
+    if seed is None:
+        seed = random.randrange(2**32)
+
+    pygame.init()
+    pygame.key.set_repeat(100, 50) # keyboard repeat behaviour. (delay, interval) unit: millisecond.
+
+    icons.preload(["icons/block-sign.ico"]) # flames appear mid-game, load their icon up front
+    ww = make_stage(seed)
+    recorder = None
+    if args.record:
+        recorder = Recorder(ww, open(args.record, 'wb'), seed)
+
+    pygame.mixer.music.load('background.mid')
+    pygame.mixer.music.play(-1, 0.0)
+
+    # YOUR COMMENT GOES HERE. BRIEFLY DESCRIBE WHAT THE FOLLOWING LOOP DOES.
+    try:
+        GameLoop(ww, tick_rate=10, recorder=recorder).run()
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
@@ -0,0 +1,84 @@
+'''
+Level files for Stages.
+
+A level is a rectangle of characters, one per cell of the Stage, row by
+row from the top:
+
+    .  empty cell         #  Wall
+    B  Box                S  StickyBox
+    P  KeyboardPlayer     N  NormalMonster
+    E  EzMonster          X  ExplodingMonster
+
+Levels written by hand are text files with one line per row. Big levels
+can be kept as .npy files instead: a 2-D uint8 NumPy array of the same
+character codes, which is memory-mapped rather than parsed when read.
+Only .npy levels need NumPy.
+'''
+
+from ww import *
+
+# character -> (Actor class, icon file, further constructor args)
+TILES = {
+    '#': (Wall, "icons/wall.jpg", ()),
+    'B': (Box, "icons/emblem-package-2-24.png", ()),
+    'S': (StickyBox, "icons/applications.ico", ()),
+    'P': (KeyboardPlayer, "icons/face-cool-24-up.png", ()),
+    'N': (NormalMonster, "icons/face-devil-grin-24.png", (3,)),
+    'E': (EzMonster, "icons/face-sick.png", (3,)),
+    'X': (ExplodingMonster, "icons/face-angry.png", (1, 20)),
+}
+
+EMPTY = b'.'
+
+
+def read_level(path):
+    '''
+    (str) -> list of bytes
+    Return the rows of the level in the file at path: a .npy file if its
+    name ends in .npy, a text file otherwise. Blank lines are skipped.
+    '''
+
+    if path.endswith('.npy'):
+        import numpy # only binary levels need NumPy
+        grid = numpy.load(path, mmap_mode='r')
+        if grid.ndim != 2 or grid.dtype != numpy.uint8:
+            raise ValueError('%s does not hold a 2-D uint8 array' % (path,))
+        return [row.tobytes() for row in grid]
+    with open(path, 'rb') as f:
+        lines = f.read().splitlines()
+    return [line.rstrip() for line in lines if line.strip()]
+
+
+def write_level(path, rows):
+    '''
+    (str, list of bytes) -> None
+    Write the level with the given rows to the file at path, as a .npy
+    file if its name ends in .npy and as text otherwise. In a .npy file,
+    short rows are padded with empty cells.
+    '''
+
+    if path.endswith('.npy'):
+        import numpy # only binary levels need NumPy
+        width = max([len(row) for row in rows] or [0])
+        grid = numpy.full((len(rows), width), ord(EMPTY), numpy.uint8)
+        for (y, row) in enumerate(rows):
+            grid[y, :len(row)] = numpy.frombuffer(row, numpy.uint8)
+        numpy.save(path, grid)
+    else:
+        with open(path, 'wb') as f:
+            f.write(b'\n'.join(rows) + b'\n')
+
+
+def load_level(path, icon_dimension, tiles=TILES, **options):
+    '''
+    (str, int, dict, ...) -> Stage
+    Return a new Stage, just big enough for the level in the file at path,
+    with the level's Actors on it. tiles is as for Stage.load_level, and
+    any further keyword options are passed on to Stage.
+    '''
+
+    rows = read_level(path)
+    width = max([len(row) for row in rows] or [0])
+    stage = Stage(width, len(rows), icon_dimension, **options)
+    stage.load_level(rows, tiles, EMPTY)
+    return stage
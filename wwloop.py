@@ -0,0 +1,214 @@
+'''
+A fixed-timestep game loop for a Stage.
+
+The simulation advances at a fixed tick rate no matter how long drawing
+takes, catching up (within a budget) after a slow frame, while drawing
+happens at its own rate.
+'''
+
+import random, time
+import pygame
+
+
+class GameLoop:
+    '''
+    Drives a Stage: polls pygame events, steps the Stage at a fixed tick
+    rate and draws it at a separate frame rate, and keeps statistics on
+    how closely the ticks and frames kept to their schedule.
+    '''
+
+    def __init__(self, stage, tick_rate=10, frame_rate=None, max_catch_up=5, spin_time=0.002, recorder=None,
+                 reservoir_size=1024):
+        '''
+        (GameLoop, Stage, float, float, int, float, Recorder, int) -> None
+        Construct a GameLoop for stage that steps it tick_rate times a second.
+
+        frame_rate is the number of draws per second. If it is None, the
+        stage is drawn once after every batch of ticks (it cannot have
+        changed in between); if it is 0, drawing is uncapped and only
+        limited by the display (for example by vsync, see the vsync option
+        of Stage).
+
+        If the loop falls behind, it runs at most max_catch_up ticks in a
+        row before drawing again; any ticks still owed after that are
+        dropped rather than replayed.
+
+        Sleeps end with a busy wait of up to spin_time seconds, because
+        time.sleep can overshoot by a millisecond or more.
+
+        If recorder is given (see wwreplay.py), every key press and tick is
+        recorded with it, so that the game can be replayed later.
+
+        Statistics take constant memory however long the loop runs: tick
+        lateness percentiles are estimated from a uniform random sample of
+        at most reservoir_size ticks.
+        '''
+
+        self._stage = stage
+        self._tick_period = 1.0 / tick_rate
+        if frame_rate:
+            self._frame_period = 1.0 / frame_rate
+        else:
+            self._frame_period = frame_rate # None or 0, see above
+        self._max_catch_up = max_catch_up
+        self._spin_time = spin_time
+        self._recorder = recorder
+        self._running = False
+
+        # statistics, see stats. Tick lateness is the time between when a
+        # tick was due and when it ran; a frame interval is the time between
+        # consecutive draws (all in seconds).
+        self._ticks = 0
+        self._max_lateness = 0.0
+        self._lateness_sample = [] # reservoir sample of tick lateness
+        self._reservoir_size = reservoir_size
+        self._sample_rng = random.Random(0)
+        self._frame_interval_count = 0
+        self._frame_interval_sum = 0.0
+        self._frame_interval_squares = 0.0
+        self._frames = 0
+        self._dropped_ticks = 0
+
+    def handle_event(self, event):
+        '''
+        (GameLoop, pygame.event.Event) -> None
+        Deal with one pygame event: quit on QUIT, and pass key presses on
+        to the stage's player.
+        '''
+
+        if event.type == pygame.QUIT:
+            self.stop()
+        elif event.type == pygame.KEYDOWN:
+            if self._recorder is not None:
+                self._recorder.key(event.key)
+            self._stage.player_event(event.key)
+
+    def stop(self):
+        '''
+        (GameLoop) -> None
+        Make run return after the current iteration.
+        '''
+
+        self._running = False
+
+    def run(self, max_ticks=None):
+        '''
+        (GameLoop, int) -> None
+        Run the game until stop is called (for example because the window
+        was closed), or until max_ticks ticks have been run.
+        '''
+
+        self._running = True
+        ticks = 0
+        now = time.perf_counter()
+        next_tick = now
+        next_frame = now
+        last_frame = None
+
+        while self._running:
+            # run every tick that is due, up to the catch-up budget
+            stepped = 0
+            now = time.perf_counter()
+            while now >= next_tick and stepped < self._max_catch_up:
+                for event in pygame.event.get():
+                    self.handle_event(event)
+                self._stage.step()
+                if self._recorder is not None:
+                    self._recorder.stepped()
+                self.record_lateness(now - next_tick)
+                next_tick += self._tick_period
+                stepped += 1
+                ticks += 1
+                if max_ticks is not None and ticks >= max_ticks:
+                    self._running = False
+                    break
+                now = time.perf_counter()
+            if stepped == self._max_catch_up and now >= next_tick:
+                # still behind after the budget: give up on the missed ticks
+                missed = int((now - next_tick) / self._tick_period) + 1
+                self._dropped_ticks += missed
+                next_tick += missed * self._tick_period
+
+            if self._frame_period is None:
+                draw = stepped > 0
+            else:
+                draw = now >= next_frame
+            if draw:
+                self._stage.draw()
+                self._frames += 1
+                now = time.perf_counter()
+                if last_frame is not None:
+                    interval = now - last_frame
+                    self._frame_interval_count += 1
+                    self._frame_interval_sum += interval
+                    self._frame_interval_squares += interval * interval
+                last_frame = now
+                if self._frame_period:
+                    next_frame = max(next_frame + self._frame_period, now - self._frame_period)
+
+            if not self._running or self._frame_period == 0:
+                continue
+            wake = next_tick
+            if self._frame_period is not None:
+                wake = min(wake, next_frame)
+            self.sleep_until(wake)
+
+    def record_lateness(self, lateness):
+        '''
+        (GameLoop, float) -> None
+        Add the lateness of one tick to the statistics, keeping a uniform
+        random sample of all the ticks so far (reservoir sampling).
+        '''
+
+        self._ticks += 1
+        self._max_lateness = max(self._max_lateness, lateness)
+        sample = self._lateness_sample
+        if len(sample) < self._reservoir_size:
+            sample.append(lateness)
+        else:
+            i = self._sample_rng.randrange(self._ticks)
+            if i < self._reservoir_size:
+                sample[i] = lateness
+
+    def sleep_until(self, deadline):
+        '''
+        (GameLoop, float) -> None
+        Wait until time.perf_counter() reaches deadline: sleep for most of
+        the time, then busy wait for the last spin_time seconds.
+        '''
+
+        remaining = deadline - time.perf_counter()
+        if remaining > self._spin_time:
+            time.sleep(remaining - self._spin_time)
+        while time.perf_counter() < deadline:
+            pass
+
+    def stats(self):
+        '''
+        (GameLoop) -> dict
+        Return how well the loop kept to its schedule so far: the number
+        of ticks and frames run and ticks dropped, the median, 99th
+        percentile and worst lateness of ticks, and the mean and standard
+        deviation of the time between frames (all times in milliseconds).
+        The percentiles are estimated from a sample once there have been
+        more ticks than the reservoir holds.
+        '''
+
+        result = {
+            'ticks': self._ticks,
+            'frames': self._frames,
+            'dropped_ticks': self._dropped_ticks,
+        }
+        if self._lateness_sample:
+            lateness = sorted(self._lateness_sample)
+            n = len(lateness)
+            result['tick_lateness_p50_ms'] = lateness[n // 2] * 1000
+            result['tick_lateness_p99_ms'] = lateness[min(n - 1, int(n * 0.99))] * 1000
+            result['tick_lateness_max_ms'] = self._max_lateness * 1000
+        if self._frame_interval_count:
+            n = self._frame_interval_count
+            mean = self._frame_interval_sum / n
+            variance = max(self._frame_interval_squares / n - mean * mean, 0.0)
+            result['frame_interval_mean_ms'] = mean * 1000
+            result['frame_interval_stddev_ms'] = variance ** 0.5 * 1000
+        return result
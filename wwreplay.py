@@ -0,0 +1,166 @@
+'''
+Recording games, and replaying them headless.
+
+A recording holds the seed the game's Stage was built from (see
+wwgame.make_stage), every key press together with the tick it came
+before, and a hash of the Stage's state (see Stage.state_hash) every so
+many ticks. Replaying builds the same Stage without a display, presses
+the same keys before the same ticks, steps it as fast as it can, and
+checks the hashes on the way, so that a game can be reproduced exactly
+and real sessions can be used as benchmarks. For example:
+
+    python wwgame.py --record game.wwr
+    python -m wwreplay game.wwr
+
+A recording is a little-endian binary file: MAGIC and the seed (SEED),
+then one record per key press or checkpoint, each a tag byte followed by
+(tick, key) packed as KEY or (tick, hash) packed as CHECKPOINT.
+'''
+
+import argparse, json, os, struct, time
+
+# keep pygame's greeting out of the JSON on stdout
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+MAGIC = b'WWR1'
+SEED = struct.Struct('<q')
+KEY = struct.Struct('<II')
+CHECKPOINT = struct.Struct('<IQ')
+KEY_TAG = b'K'
+CHECKPOINT_TAG = b'C'
+
+
+class Recorder:
+    '''
+    Writes a recording of the game played on a Stage to a binary file.
+    A GameLoop given a Recorder calls key for every key press and stepped
+    after every tick.
+    '''
+
+    def __init__(self, stage, f, seed, checkpoint_every=100):
+        '''
+        (Recorder, Stage, file, int, int) -> None
+        Start recording the game on stage, which was built from seed, to
+        the binary file f, with a checkpoint every checkpoint_every ticks.
+        '''
+
+        self._stage = stage
+        self._file = f
+        self._checkpoint_every = checkpoint_every
+        f.write(MAGIC + SEED.pack(seed))
+
+    def key(self, key):
+        '''
+        (Recorder, int) -> None
+        Record that key was pressed before the next tick.
+        '''
+
+        self._file.write(KEY_TAG + KEY.pack(self._stage.get_tick(), key))
+
+    def stepped(self):
+        '''
+        (Recorder) -> None
+        Record a checkpoint if one is due after the tick just run.
+        '''
+
+        if self._stage.get_tick() % self._checkpoint_every == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        '''
+        (Recorder) -> None
+        Record the hash of the Stage's state at the current tick.
+        '''
+
+        self._file.write(CHECKPOINT_TAG + CHECKPOINT.pack(self._stage.get_tick(), self._stage.state_hash()))
+
+    def close(self):
+        '''
+        (Recorder) -> None
+        Record a final checkpoint, so that a replay runs up to the tick the
+        game ended on, and close the file.
+        '''
+
+        self.checkpoint()
+        self._file.close()
+
+
+def read_recording(f):
+    '''
+    (file) -> (int, list of (bytes, int, int))
+    Read the recording in binary file f and return its seed and its
+    records, as (tag, tick, key or hash), in order.
+    '''
+
+    data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a recording')
+    (seed,) = SEED.unpack_from(data, len(MAGIC))
+    records = []
+    offset = len(MAGIC) + SEED.size
+    while offset < len(data):
+        tag = data[offset:offset+1]
+        if tag == KEY_TAG:
+            record = KEY
+        elif tag == CHECKPOINT_TAG:
+            record = CHECKPOINT
+        else:
+            raise ValueError('bad record tag %r at byte %d' % (tag, offset))
+        (tick, value) = record.unpack_from(data, offset + 1)
+        records.append((tag, tick, value))
+        offset += 1 + record.size
+    return (seed, records)
+
+
+def replay(path, make_stage=None, check=True):
+    '''
+    (str, function, bool) -> (Stage, int)
+    Replay the recording at path on the Stage make_stage(seed, headless=True)
+    builds (wwgame.make_stage by default), and return the Stage at the end
+    of the recording and the number of checkpoints passed. If check is
+    True, raise ValueError at the first checkpoint the replay disagrees with.
+    '''
+
+    if make_stage is None:
+        from wwgame import make_stage
+    with open(path, 'rb') as f:
+        (seed, records) = read_recording(f)
+    stage = make_stage(seed, headless=True)
+    checkpoints = 0
+    for (tag, tick, value) in records:
+        while stage.get_tick() < tick:
+            stage.step()
+        if tag == KEY_TAG:
+            stage.player_event(value)
+        elif check:
+            if stage.state_hash() != value:
+                raise ValueError('replay differs from the recording at tick %d' % (tick,))
+            checkpoints += 1
+    return (stage, checkpoints)
+
+
+def main(argv=None):
+    '''
+    (list of str) -> None
+    Replay a recording and print how long it took as JSON.
+    '''
+
+    parser = argparse.ArgumentParser(prog='python -m wwreplay', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recording')
+    parser.add_argument('--no-check', action='store_true', help='do not compare the checkpoint hashes')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    (stage, checkpoints) = replay(args.recording, check=not args.no_check)
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        'ticks': stage.get_tick(),
+        'checkpoints': checkpoints,
+        'seconds': seconds,
+        'ticks_per_sec': stage.get_tick() / seconds if seconds > 0 else None,
+        'state_hash': stage.state_hash(),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,572 @@
+'''
+Array-backed storage for the Actors on a vectorized Stage.
+
+An ActorStore keeps the state of every Actor on a Stage in NumPy arrays,
+one row per Actor, along with a grid of what is in each cell. That is
+what Stage.get_grid hands out, what trap_detection='grid' works from,
+and what snapshots copy in one go. A MonsterBatch uses the arrays to
+update the life and delay counters of the NormalMonsters and EzMonsters
+together at the end of a step.
+
+The Actors themselves become thin views over their rows: while an Actor
+is in a store, reading or writing its position, life, delay counters,
+direction or stuck flag reads or writes the arrays. That makes each of
+those accesses slower, so a vectorized Stage steps slower than a plain
+one (about 24 against 16 ms a tick on a 150x150 board with 9.5k
+Actors, see wwbench.py); it is for when the arrays are wanted. This
+module needs NumPy; ww.py only imports it for Stages created with
+vectorized=True.
+'''
+
+import numpy
+from ww import *
+
+# type ids stored in ActorStore.kind. 0 marks a free row.
+EMPTY = 0
+WALL = 1
+BOX = 2
+STICKY_BOX = 3
+PLAYER = 4
+NORMAL_MONSTER = 5
+EZ_MONSTER = 6
+EXPLODING_MONSTER = 7
+FLAME = 8
+OTHER = 9 # any other Actor
+MONSTER = 10 # any other Monster
+
+# the most specific class comes first, so that kind_of finds it first
+KINDS = [
+    (StickyBox, STICKY_BOX),
+    (Box, BOX),
+    (Wall, WALL),
+    (Player, PLAYER),
+    (NormalMonster, NORMAL_MONSTER),
+    (EzMonster, EZ_MONSTER),
+    (ExplodingMonster, EXPLODING_MONSTER),
+    (Flame, FLAME),
+    (Monster, MONSTER),
+    (Actor, OTHER),
+]
+
+# (column name, Actor attribute, dtype) for every column of an ActorStore
+COLUMNS = [
+    ('x', '_x', numpy.int32),
+    ('y', '_y', numpy.int32),
+    ('life', '_life', numpy.int32),
+    ('delay', '_delay', numpy.int32),
+    ('delay_count', '_delay_count', numpy.int32),
+    ('dx', '_dx', numpy.int8),
+    ('dy', '_dy', numpy.int8),
+    ('stuck', 'stuck', numpy.bool_),
+    ('monster_trapped', 'trapped', numpy.bool_), # ActorStore.trapped is the trapped grid
+]
+
+# the columns that ActorStore.channel can lay out over the grid
+CHANNELS = ('life', 'dx', 'dy')
+
+# the kinds of Actor that a trapped Monster is surrounded by (Boxes and Monsters)
+BLOCKING = (BOX, STICKY_BOX, NORMAL_MONSTER, EZ_MONSTER, EXPLODING_MONSTER, FLAME, MONSTER)
+
+# the kinds of Monster whose steps a MonsterBatch can take for them
+BATCHED = (NORMAL_MONSTER, EZ_MONSTER)
+
+_kinds = {} # Actor class -> type id, filled in by kind_of
+_view_classes = {} # Actor class -> its view class, filled in by view_class
+
+
+def kind_of(cls):
+    '''
+    (type) -> int
+    Return the type id for Actors of class cls.
+    '''
+
+    kind = _kinds.get(cls)
+    if kind is None:
+        kind = OTHER
+        for (kind_cls, kind_id) in KINDS:
+            if issubclass(cls, kind_cls):
+                kind = kind_id
+                break
+        _kinds[cls] = kind
+    return kind
+
+
+def _column_property(column):
+    '''
+    (str) -> property
+    Return a property that reads and writes an Actor's entry in the given
+    column of its Stage's ActorStore.
+    '''
+
+    def get(actor):
+        return getattr(actor._stage._store, column).item(actor._row)
+
+    def set(actor, value):
+        getattr(actor._stage._store, column)[actor._row] = value
+
+    return property(get, set)
+
+
+def view_class(cls):
+    '''
+    (type) -> type
+    Return the view class for Actor class cls: a subclass of cls, with the
+    same instance layout, whose stored attributes live in an ActorStore.
+    An Actor is turned into a view by assigning it this class.
+    '''
+
+    view = _view_classes.get(cls)
+    if view is None:
+        namespace = {'__slots__': (), '__module__': cls.__module__, '__doc__': cls.__doc__}
+        for (column, attribute, dtype) in COLUMNS:
+            if hasattr(cls, attribute):
+                namespace[attribute] = _column_property(column)
+        view = type(cls.__name__, (cls,), namespace)
+        view._base_class = cls
+        _view_classes[cls] = view
+        _view_classes[view] = view
+        _kinds[view] = kind_of(cls)
+    return view
+
+
+class ActorStore:
+    '''
+    The state of the Actors on a Stage, as a NumPy array per attribute
+    (see COLUMNS) plus the type id of each row in kind.
+    Rows of removed Actors are reused by later ones.
+
+    The store also keeps an occupancy grid of the Stage: grid[y, x] is the
+    type id of the first Actor in cell (x, y), and grid_row[y, x] its row
+    (or -1 if the cell is empty).
+    '''
+
+    def __init__(self, width, height, capacity=64):
+        '''
+        (ActorStore, int, int, int) -> None
+        Construct an empty ActorStore for a Stage of the given width and
+        height, with room for capacity Actors before its arrays have to grow.
+        '''
+
+        self._width, self._height = width, height
+        self.grid = numpy.zeros((height, width), numpy.int8)
+        self.grid_row = numpy.full((height, width), -1, numpy.int32)
+        # trapped[y, x] is True iff the 3x3 square around (x, y) was all
+        # blocked when find_trapped was last called, and _stale[y, x] is
+        # True iff a cell in that square has changed since then
+        self.trapped = numpy.zeros((height, width), bool)
+        self._stale = numpy.ones((height, width), bool)
+        # channel name -> array like grid, see channel
+        self.channels = {}
+        self._empty = numpy.zeros((height, width), bool) # scratch for update_channels
+
+        self.kind = numpy.zeros(capacity, numpy.int8)
+        for (column, attribute, dtype) in COLUMNS:
+            setattr(self, column, numpy.zeros(capacity, dtype))
+        self._free = list(range(capacity - 1, -1, -1)) # free rows, lowest last
+        self._count = 0
+
+    def __len__(self):
+        '''
+        (ActorStore) -> int
+        Return the number of Actors in this ActorStore.
+        '''
+
+        return self._count
+
+    def _grow(self):
+        '''
+        (ActorStore) -> None
+        Double the number of rows.
+        '''
+
+        capacity = len(self.kind)
+        self.kind = numpy.concatenate((self.kind, numpy.zeros(capacity, self.kind.dtype)))
+        for (column, attribute, dtype) in COLUMNS:
+            old = getattr(self, column)
+            setattr(self, column, numpy.concatenate((old, numpy.zeros(capacity, dtype))))
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, actor):
+        '''
+        (ActorStore, Actor) -> int
+        Move actor's state into a row of this ActorStore, make actor a view
+        over that row, and return the row.
+        '''
+
+        if actor._row is not None:
+            return actor._row
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        cls = type(actor)
+        self.kind[row] = kind_of(cls)
+        for (column, attribute, dtype) in COLUMNS:
+            if hasattr(cls, attribute):
+                getattr(self, column)[row] = getattr(actor, attribute)
+        actor._row = row
+        actor.__class__ = view_class(cls)
+        self._count += 1
+        return row
+
+    def add_all(self, actors):
+        '''
+        (ActorStore, list of Actor) -> None
+        Add all of actors, none of which is in a store yet, as add would,
+        but filling in each column for all of them at once.
+        '''
+
+        n = len(actors)
+        while len(self._free) < n:
+            self._grow()
+        rows = self._free[len(self._free) - n:]
+        del self._free[len(self._free) - n:]
+        rows.reverse() # lowest first, as add would take them
+        self.kind[rows] = [kind_of(type(actor)) for actor in actors]
+        for (column, attribute, dtype) in COLUMNS:
+            getattr(self, column)[rows] = [getattr(actor, attribute, 0) for actor in actors]
+        for (actor, row) in zip(actors, rows):
+            actor._row = row
+            actor.__class__ = view_class(type(actor))
+        self._count += n
+
+    def remove(self, actor):
+        '''
+        (ActorStore, Actor) -> None
+        Copy actor's state back into actor, so that it stops being a view,
+        and free its row.
+        '''
+
+        row = actor._row
+        if row is None:
+            return
+        values = []
+        for (column, attribute, dtype) in COLUMNS:
+            if hasattr(type(actor), attribute):
+                values.append((attribute, getattr(actor, attribute)))
+        actor.__class__ = type(actor)._base_class
+        for (attribute, value) in values:
+            setattr(actor, attribute, value)
+        actor._row = None
+        self.kind[row] = EMPTY
+        self._free.append(row)
+        self._count -= 1
+
+    def view(self, actor):
+        '''
+        (ActorStore, Actor) -> None
+        Make actor, whose row is already in actor._row, a view over it again
+        (see Stage.restore).
+        '''
+
+        actor.__class__ = view_class(type(actor))
+
+    def snapshot(self):
+        '''
+        (ActorStore) -> tuple
+        Return a copy of the columns of this ActorStore, for restore.
+        '''
+
+        return (self.kind.copy(),) + tuple([getattr(self, column).copy() for (column, attribute, dtype) in COLUMNS])
+
+    def changed_rows(self, state):
+        '''
+        (ActorStore, tuple) -> set of int
+        Return the rows whose kind or columns differ from what they were
+        when snapshot returned state.
+        '''
+
+        rows = len(state[0])
+        if len(self.kind) != rows:
+            # the rows that came or went since differ by definition
+            rows = min(rows, len(self.kind))
+            different = set(range(rows, max(len(self.kind), len(state[0]))))
+        else:
+            different = set()
+        changed = self.kind[:rows] != state[0][:rows]
+        for ((column, attribute, dtype), values) in zip(COLUMNS, state[1:]):
+            changed |= getattr(self, column)[:rows] != values[:rows]
+        different.update(numpy.flatnonzero(changed).tolist())
+        return different
+
+    def restore(self, state):
+        '''
+        (ActorStore, tuple) -> None
+        Put the columns of this ActorStore back as they were when snapshot
+        returned state. The grid and the Actors themselves are left as they
+        are, for Stage.restore to see to.
+        '''
+
+        self.kind = state[0].copy()
+        for ((column, attribute, dtype), values) in zip(COLUMNS, state[1:]):
+            setattr(self, column, values.copy())
+        self._free = numpy.flatnonzero(self.kind == EMPTY)[::-1].tolist()
+        self._count = len(self.kind) - len(self._free)
+        self._stale.fill(True) # trapped may be out of date
+
+    def set_cell(self, position, actor):
+        '''
+        (ActorStore, tuple of two ints, Actor) -> None
+        Record that actor (or nobody, if actor is None) is now the first
+        Actor in the cell at position. Cells off the Stage are ignored.
+        '''
+
+        (x, y) = position
+        if 0 <= x < self._width and 0 <= y < self._height:
+            was_blocking = self.grid.item(y, x) in BLOCKING
+            if actor is None:
+                self.grid[y, x] = EMPTY
+                self.grid_row[y, x] = -1
+            else:
+                self.grid[y, x] = self.kind[actor._row]
+                self.grid_row[y, x] = actor._row
+            if (self.grid.item(y, x) in BLOCKING) != was_blocking:
+                self._stale[max(y-1, 0):y+2, max(x-1, 0):x+2] = True
+
+    def set_cells(self, actors):
+        '''
+        (ActorStore, list of Actor) -> None
+        Record that each of actors, which are all in this store and in
+        different cells, is now the first Actor in its cell. Cells off the
+        Stage are ignored.
+        '''
+
+        rows = numpy.fromiter((actor._row for actor in actors), numpy.intp, len(actors))
+        xs = self.x[rows]
+        ys = self.y[rows]
+        on_stage = (xs >= 0) & (xs < self._width) & (ys >= 0) & (ys < self._height)
+        (rows, xs, ys) = (rows[on_stage], xs[on_stage], ys[on_stage])
+        self.grid[ys, xs] = self.kind[rows]
+        self.grid_row[ys, xs] = rows
+        self._stale.fill(True)
+
+    def clear_cells(self):
+        '''
+        (ActorStore) -> None
+        Record that every cell is empty.
+        '''
+
+        self.grid.fill(EMPTY) # in place, Stage.get_grid hands out views of it
+        self.grid_row.fill(-1)
+        self._stale.fill(True)
+
+    def channel(self, name):
+        '''
+        (ActorStore, str) -> numpy.ndarray
+        Return an array like grid holding the value of column name (one of
+        CHANNELS) for the first Actor in each cell, or 0 for an empty cell.
+        From now on, update_channels refreshes it in place.
+        '''
+
+        if name not in self.channels:
+            if name not in CHANNELS:
+                raise ValueError('unknown channel: %r' % (name,))
+            self.channels[name] = numpy.zeros(self.grid.shape, getattr(self, name).dtype)
+            self.update_channels()
+        return self.channels[name]
+
+    def update_channels(self):
+        '''
+        (ActorStore) -> None
+        Bring every channel asked for so far up to date with the columns
+        and the grid, without allocating new arrays.
+        '''
+
+        if not self.channels:
+            return
+        numpy.less(self.grid_row, 0, out=self._empty)
+        for (name, values) in self.channels.items():
+            # empty cells take row -1 here, and are then zeroed
+            numpy.take(getattr(self, name), self.grid_row, out=values, mode='wrap')
+            numpy.copyto(values, 0, where=self._empty)
+
+    def find_trapped(self):
+        '''
+        (ActorStore) -> None
+        Work out, for every cell at once, whether the 3x3 square around it
+        is entirely off the stage or blocked by Boxes and Monsters, and
+        store the answer in self.trapped.
+        '''
+
+        (height, width) = self.grid.shape
+        blocked = numpy.ones((height + 2, width + 2), bool) # the border is off the stage
+        blocked[1:-1, 1:-1] = numpy.isin(self.grid, BLOCKING)
+        rows = blocked[:, :-2] & blocked[:, 1:-1] & blocked[:, 2:]
+        self.trapped = rows[:-2] & rows[1:-1] & rows[2:]
+        self._stale.fill(False)
+
+    def start_step(self):
+        '''
+        (ActorStore) -> MonsterBatch
+        Get ready for a step of the Stage: find the trapped cells, and
+        return the batch for the step's Monsters.
+        '''
+
+        self.find_trapped()
+        return MonsterBatch(self)
+
+    def is_trapped(self, x, y):
+        '''
+        (ActorStore, int, int) -> bool
+        Return True iff every cell in the 3x3 square around (x, y), which
+        is on the Stage, is off the Stage or blocked by a Box or Monster.
+        The answer comes from the last find_trapped unless a cell in the
+        square has changed since, in which case the square is looked at.
+        '''
+
+        if not self._stale.item(y, x):
+            return self.trapped.item(y, x)
+        for cy in (y-1, y, y+1):
+            for cx in (x-1, x, x+1):
+                if 0 <= cx < self._width and 0 <= cy < self._height and self.grid.item(cy, cx) not in BLOCKING:
+                    return False
+        return True
+
+    def rows(self, kinds=None):
+        '''
+        (ActorStore, list of int) -> numpy.ndarray
+        Return the rows in use, in increasing order; only those whose type
+        id is in kinds, if kinds is given.
+        '''
+
+        if kinds is None:
+            return numpy.flatnonzero(self.kind != EMPTY)
+        return numpy.flatnonzero(numpy.isin(self.kind, kinds))
+
+    def count_down(self, rows):
+        '''
+        (ActorStore, numpy.ndarray) -> numpy.ndarray
+        Advance the delay counters of the given rows, as Actor.delay does
+        for one Actor, and return a boolean array telling which of them
+        wrapped around to 0 (that is, which Actors get to act).
+        '''
+
+        counts = (self.delay_count[rows] + 1) % self.delay[rows]
+        self.delay_count[rows] = counts
+        return counts == 0
+
+    def drain_life(self, rows, amount=1):
+        '''
+        (ActorStore, numpy.ndarray, int) -> None
+        Take amount of life away from each of the given rows.
+        '''
+
+        self.life[rows] -= amount
+
+
+class MonsterBatch:
+    '''
+    One Stage.step of the NormalMonsters and EzMonsters in an ActorStore.
+
+    Unless it is dead or stuck, such a Monster's step works out whether it
+    is trapped, sets its life from that, counts down its delay, and moves
+    if the count wrapped around. The Stage still visits the Monsters in
+    schedule order, and visit takes the step of each one it can: it notes
+    whether the Monster is trapped (which depends on where the Actors that
+    stepped before it have got to) and makes it move if it is its turn to,
+    but leaves its life, trapped flag and delay counter to finish, which
+    updates them for all of them at once at the end of the step. The dead
+    and stuck Monsters take their own steps.
+
+    Nothing but its own step reads a Monster's life or delay counter, so
+    putting those off changes nothing, as long as the Stage tells the
+    batch when somebody else sets one's life (life_changed) or removes
+    one (removing).
+    '''
+
+    def __init__(self, store):
+        '''
+        (MonsterBatch, ActorStore) -> None
+        Start the batch for a step, before any Actor of it has stepped. The
+        trapped grid of store must be up to date (see find_trapped).
+        '''
+
+        self._store = store
+        rows = store.rows(BATCHED)
+        delays = store.delay[rows]
+        taken = (store.life[rows] != 0) & ~store.stuck[rows] & (delays > 0)
+        taken &= (store.x[rows] >= 0) & (store.x[rows] < store._width)
+        taken &= (store.y[rows] >= 0) & (store.y[rows] < store._height)
+        rows = rows[taken]
+        moving = (store.delay_count[rows] + 1) % delays[taken] == 0
+        self._candidates = set(rows.tolist()) # rows whose step this batch may take
+        self._movers = set(rows[moving].tolist()) # the ones of those that move
+        # the rows whose steps were taken so far, whether each was trapped,
+        # and whether its life has been set since (which wins over the life
+        # finish would set)
+        self._rows = []
+        self._trapped = []
+        self._life_set = []
+        self._index = {} # row not finished yet -> its index in self._rows
+
+    def visit(self, actor):
+        '''
+        (MonsterBatch, Actor) -> bool
+        Take the step actor is due to take now and return True, or return
+        False if actor has to take it itself.
+        '''
+
+        row = actor._row
+        if row not in self._candidates:
+            return False
+        store = self._store
+        if store.stuck.item(row): # stuck since the step began
+            return False
+        self._candidates.discard(row)
+        self._index[row] = len(self._rows)
+        self._rows.append(row)
+        self._trapped.append(store.is_trapped(store.x.item(row), store.y.item(row)))
+        self._life_set.append(False)
+        if row in self._movers:
+            actor.move(actor, actor._dx, actor._dy)
+        return True
+    def life_changed(self, actor):
+        '''
+        (MonsterBatch, Actor) -> None
+        Record that somebody set actor's life during the step.
+        '''
+
+        row = actor._row
+        i = self._index.get(row)
+        if i is not None:
+            self._life_set[i] = True
+        else:
+            self._candidates.discard(row) # its own step has to deal with it
+
+    def removing(self, actor):
+        '''
+        (MonsterBatch, Actor) -> None
+        Finish actor's step, if this batch took it, before it leaves the store.
+        '''
+
+        row = actor._row
+        self._candidates.discard(row)
+        i = self._index.pop(row, None)
+        if i is not None:
+            self._settle(numpy.array([row]), numpy.array([self._trapped[i]]), numpy.array([self._life_set[i]]))
+            self._rows[i] = -1
+
+    def finish(self):
+        '''
+        (MonsterBatch) -> None
+        Do the bookkeeping of every step taken and not finished yet.
+        '''
+
+        rows = numpy.array(self._rows, numpy.intp)
+        left = rows >= 0
+        self._settle(rows[left], numpy.array(self._trapped, bool)[left], numpy.array(self._life_set, bool)[left])
+        self._index.clear()
+
+    def _settle(self, rows, trapped, life_set):
+        '''
+        (MonsterBatch, numpy.ndarray, numpy.ndarray, numpy.ndarray) -> None
+        Do the bookkeeping of Monster.step for the given rows, given whether
+        each is trapped and whether its life has been set since its turn.
+        '''
+
+        store = self._store
+        store.count_down(rows)
+        store.monster_trapped[rows] = trapped
+        rows = rows[~life_set]
+        trapped = trapped[~life_set]
+        store.drain_life(rows[trapped])
+        store.life[rows[~trapped]] = 5